@@ -1,23 +1,44 @@
 
-import numpy as np
+import uuid
+
+import plotly
 import dash
 from dash.dependencies import Input, Output, State
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_table as dt
 from dash.exceptions import PreventUpdate
+from flask_caching import Cache
 
 from src import classes
 from src import plotting
 
 
+# Dash serializes callback responses with the Plotly JSON encoder; swap in
+# the orjson based one so the figure arrays aren't encoded one by one
+plotly.utils.PlotlyJSONEncoder = plotting.OrjsonEncoder
+
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
+# Uploaded spectra and catalogs live server-side in their `to_store` form;
+# the browser Store only holds the keys needed to retrieve them. Entries
+# don't expire, but once the threshold is reached the cache prunes itself,
+# so the callbacks have to cope with keys that have gone missing
+cache = Cache(
+    app.server,
+    config={
+        "CACHE_TYPE": "filesystem",
+        "CACHE_DIR": ".cache",
+        "CACHE_DEFAULT_TIMEOUT": 0,
+        "CACHE_THRESHOLD": 1000
+    }
+)
 
 app.layout = html.Div(
     [
         dcc.Store(id="stored-data", storage_type="session"),
+        dcc.Store(id="table-prev"),
         html.Div(
             [
                 dcc.Upload(
@@ -65,48 +86,69 @@ app.layout = html.Div(
 def upload_file(uploaded_files, filenames, data):
     """
     This creates a callback function for when a user uploads one or multiple catalog files.
-    The data is stored in a hidden Dash div (`Store` object), which holds
-    a dictionary that separates a spectrum from catalog files.
+    The parsed objects are put into the server-side cache, and the hidden Dash
+    div (`Store` object) holds a dictionary of their cache keys that separates
+    a spectrum from catalog files.
     :param uploaded_files: list of file stream from Dash `Upload`
     :param filenames: list of str uploaded file name
-    :param data: dict containing spectrum and catalog data
-    :return: updated dictionary of data
+    :param data: dict containing spectrum and catalog cache keys
+    :return: updated dictionary of cache keys
     """
     # Only update if a file is actually uploaded
     if uploaded_files is None:
         raise PreventUpdate
-    # In case there's no data yet, initialize with empty dicts
-    data = data or {"spectrum": {}, "catalogs": {}}
+    # In case there's no data yet, initialize with empty values
+    data = data or {"spectrum": None, "catalogs": {}}
     for uploaded_file, filename in zip(uploaded_files, filenames):
         # Check filename extension to determine which bin the data goes into
         upload_obj = classes.process_upload(uploaded_file, filename)
+        key = uuid.uuid4().hex
+        cache.set(key, upload_obj.to_store())
         # If the uploaded object returns a Spectrum, then assign it to spectrum
         if type(upload_obj) == classes.Spectrum:
-            data["spectrum"] = upload_obj.__dict__
+            old_key = data["spectrum"]
+            data["spectrum"] = key
         else:
-            data["catalogs"][upload_obj.molecule] = upload_obj.__dict__
+            old_key = data["catalogs"].get(upload_obj.molecule)
+            data["catalogs"][upload_obj.molecule] = key
+        # Replaced uploads are no longer reachable, so free their entries
+        if old_key is not None:
+            cache.delete(old_key)
     return data
 
 
-@app.callback(Output("main-graph", "figure"),
+@app.callback([Output("main-graph", "figure"), Output("table-prev", "data")],
               [
                   Input("stored-data", "data"),
                   Input("catalog-table", "derived_virtual_data"),
-              ]
+              ],
+              [State("table-prev", "data")]
               )
-def update_figure(data, table_data):
+def update_figure(data, table_data, prev_table_data):
     """
     This callback is set up to track the hidden div data. When something
     changes from the user uploading a spectrum or catalog file, the main
-    graph is updated with the latest data.
-    :param data: dict from the hidden div Store
+    graph is updated with the latest data. The table data used for the plot
+    is kept in a hidden Store, so that DataTable events which do not change
+    any values can be skipped.
+    :param data: dict of cache keys from the hidden div Store
     :param table_data: list of dicts from the DataTable
-    :return: dict with plot specifications
+    :param prev_table_data: list of dicts from the DataTable at the last update
+    :return: dict with plot specifications, and the table data used
     """
     plots = list()
     if data is None:
         raise PreventUpdate
-    spec_obj = classes.Spectrum(**data["spectrum"])
+    triggered = dash.callback_context.triggered[0]["prop_id"]
+    if triggered.startswith("catalog-table") and table_data == prev_table_data:
+        raise PreventUpdate
+    # Nothing can be plotted until a spectrum has been uploaded
+    if data["spectrum"] is None:
+        raise PreventUpdate
+    spec_data = cache.get(data["spectrum"])
+    if spec_data is None:
+        raise PreventUpdate
+    spec_obj = classes.Spectrum.from_store(spec_data)
     # Create a Plotly Scatter trace
     plots.append(
         plotting.plot_spectrum(
@@ -117,18 +159,17 @@ def update_figure(data, table_data):
         )
     )
     if len(data["catalogs"]) > 0:
-        for molecule, cat_data in data["catalogs"].items():
-            if table_data:
-                table_dict = [
-                    cat for cat in table_data if cat.get("molecule") == cat_data["molecule"]
-                ][0]
-                cat_data.update(table_dict)
-            # This part is stupid because typing is enforced...
-            for col in ["frequency", "intensity", "state_energies"]:
-                cat_data[col] = np.array(cat_data[col])
-            for col in ["temperature", "column_density", "doppler"]:
-                cat_data[col] = np.float(cat_data[col])
-            cat_obj = classes.Catalog(**cat_data)
+        table_by_molecule = {row.get("molecule"): row for row in table_data or []}
+        for molecule, key in data["catalogs"].items():
+            cat_data = cache.get(key)
+            # Skip catalogs that have been pruned from the cache
+            if cat_data is None:
+                continue
+            cat_obj = classes.Catalog.from_store(cat_data)
+            table_dict = table_by_molecule.get(molecule)
+            if table_dict:
+                for col in ["temperature", "column_density", "doppler"]:
+                    setattr(cat_obj, col, float(table_dict[col]))
             sim_y = cat_obj.generate_spectrum(
                 spec_obj.x
             )
@@ -143,7 +184,7 @@ def update_figure(data, table_data):
         "data": plots,
         "layout": plotting.init_layout()
     }
-    return plot_data
+    return plot_data, table_data
 
 
 @app.callback(
@@ -157,10 +198,16 @@ def update_table(data):
     :param data:
     :return:
     """
-    if len(data["catalogs"]) == 0:
+    if data is None or len(data["catalogs"]) == 0:
         raise PreventUpdate
-    cat_objs = [classes.Catalog(**catalog) for catalog in data["catalogs"].values()]
-    table_data = [cat_obj.to_table_format() for cat_obj in cat_objs]
+    # The table only needs the scalar parameters, so the stored catalogs
+    # are filtered directly rather than decoded into Catalog objects.
+    # Catalogs that have been pruned from the cache are left out
+    stored = [cache.get(key) for key in data["catalogs"].values()]
+    table_data = [
+        classes.Catalog.table_format(cat_data) for cat_data in stored
+        if cat_data is not None
+    ]
     return table_data
 
 
@@ -1,3 +1,4 @@
 from . import classes
+from . import downsample
 from . import plotting
 from . import utils
\ No newline at end of file
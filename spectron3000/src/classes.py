@@ -1,20 +1,73 @@
 
 
 import base64
+import hashlib
 import io
 import os
+import threading
+from collections import OrderedDict
 from dataclasses import dataclass
 
 import numpy as np
-import pandas as pd
 
 from src import utils
 
+# Synthetic spectra memoized by a digest of the frequency grid and catalog
+# lines, and the catalog parameters, so that re-rendering the figure only
+# recomputes the catalogs that changed. As the key identifies the data
+# itself, entries can be shared between sessions; they are read-only, and
+# the lock keeps the server threads from evicting entries mid-lookup
+_SPEC_CACHE = OrderedDict()
+_SPEC_CACHE_LOCK = threading.Lock()
+_SPEC_CACHE_SIZE = 16
+# Number of Doppler widths either side of a line center that are evaluated
+_LINE_WINDOW = 8.
+# Whether large synthetic spectra are generated in single precision, and
+# the number of lines times frequencies above which a spectrum is large
+SPECTRON_FP32 = True
+_FP32_THRESHOLD = 10**7
+# Size in bytes above which spectra are parsed with pandas instead of NumPy;
+# this relies on the C implementation of loadtxt in NumPy 1.23 onwards
+_NUMPY_PARSE_LIMIT = 2**20
+# SPCAT intensities are log10 values, which are converted with exp
+_LN10 = np.log(10.)
+
+
+def _decode_upload(contents):
+    """
+    Decode the base64 payload of a Dash upload into a binary stream, which
+    the parsers can read without first decoding it into a string.
+    :param contents: data stream from Dash upload form
+    :return: io.BytesIO of the file contents
+    """
+    content_type, _, content_string = contents.partition(",")
+    return io.BytesIO(base64.b64decode(content_string))
+
+
+def _encode_array(array):
+    """
+    Encode an array as a base64 string of its raw float64 bytes.
+    :param array: np.array to encode
+    :return: str
+    """
+    return base64.b64encode(
+        np.ascontiguousarray(array, dtype=np.float64).tobytes()
+    ).decode()
+
+
+def _decode_array(string):
+    """
+    Decode a base64 string made by `_encode_array` back into an array.
+    :param string: str of base64 encoded float64 bytes
+    :return: np.array
+    """
+    return np.frombuffer(base64.b64decode(string), dtype=np.float64)
+
 
 @dataclass
 class Spectrum:
-    x: np.array
-    y: np.array
+    x: np.ndarray
+    y: np.ndarray
     comment: str = "Observation"
 
     @classmethod
@@ -25,21 +78,63 @@ class Spectrum:
         :param filename: str filename
         :return: Spectrum object
         """
-        content_type, content_string = contents.split(",")
-        decoded = base64.b64decode(content_string)
-        # Here pandas is simply being used as a parser...
-        # It's not great, but I'd need to figure out how the decoded
-        # string works before I can write my own.
-        # TODO - write own parser and replace pandas here
-        df = pd.read_csv(
-            io.StringIO(decoded.decode("utf-8")),
-            sep="\t"
-        )
-        x = df[df.columns[0]].values
-        y = df[df.columns[1]].values
+        stream = _decode_upload(contents)
+        x = None
+        # Only the first two columns are read, skipping the header row.
+        # NumPy has less overhead on small files, while the pandas
+        # tokenizer is faster on large ones
+        if stream.getbuffer().nbytes <= _NUMPY_PARSE_LIMIT:
+            try:
+                x, y = np.loadtxt(
+                    stream,
+                    delimiter="\t",
+                    skiprows=1,
+                    usecols=(0, 1),
+                    unpack=True,
+                    ndmin=2,
+                    dtype=np.float64
+                )
+            except ValueError:
+                # Files NumPy can't handle, e.g. with missing values,
+                # are left to pandas
+                stream.seek(0)
+        if x is None:
+            # pandas is slow to import and only needed here, so it is
+            # imported on first use rather than at startup
+            import pandas as pd
+            df = pd.read_csv(
+                stream,
+                sep="\t",
+                usecols=[0, 1]
+            )
+            x = df[df.columns[0]].values
+            y = df[df.columns[1]].values
         spec_obj = cls(x, y, os.path.basename(filename))
         return spec_obj
 
+    @classmethod
+    def from_store(cls, data):
+        """
+        Method for recreating a Spectrum object from the output of `to_store`.
+        :param data: dict of stored spectrum data
+        :return: Spectrum object
+        """
+        data = dict(data)
+        for key in ["x", "y"]:
+            data[key] = _decode_array(data[key])
+        return cls(**data)
+
+    def to_store(self):
+        """
+        Packs the spectrum into a dict for storage, with the arrays encoded
+        as base64 strings of float64 bytes.
+        :return: dict of stored spectrum data
+        """
+        data = dict(self.__dict__)
+        for key in ["x", "y"]:
+            data[key] = _encode_array(data[key])
+        return data
+
     def save_table(self, filepath):
         if hasattr(self, "table"):
             self.table.to_csv(
@@ -50,15 +145,31 @@ class Spectrum:
 
 @dataclass
 class Catalog:
-    frequency: np.array
-    intensity: np.array
-    state_energies: np.array
+    frequency: np.ndarray
+    intensity: np.ndarray
+    state_energies: np.ndarray
     molecule: str
     temperature: float = 300.0
     column_density: float = 1e15
     doppler: float = 5.0
     Q: float = 1.0
 
+    def __post_init__(self):
+        # Line intensities and energies are held in single precision to halve
+        # their memory; calculations with them are done in double precision.
+        # Frequencies stay in double precision, as rounding would shift the
+        # line centres by a sizeable fraction of a narrow line width.
+        # The lines are also kept sorted by frequency, so that the lines
+        # near any part of a spectrum can be found with a binary search
+        self.frequency = np.asarray(self.frequency, dtype=np.float64)
+        self.intensity = np.asarray(self.intensity, dtype=np.float32)
+        self.state_energies = np.asarray(self.state_energies, dtype=np.float32)
+        if np.any(np.diff(self.frequency) < 0.):
+            order = np.argsort(self.frequency)
+            self.frequency = self.frequency[order]
+            self.intensity = self.intensity[order]
+            self.state_energies = self.state_energies[order]
+
     @classmethod
     def from_upload(cls, contents, filename):
         """
@@ -67,44 +178,55 @@ class Catalog:
         :param filename: str filename
         :return: Spectrum object
         """
-        content_type, content_string = contents.split(",")
-        decoded = base64.b64decode(content_string)
-        # Here pandas is simply being used as a parser...
-        # It's not great, but I'd need to figure out how the decoded
-        # string works before I can write my own.
-        # TODO - write own parser and replace pandas here
-        df = pd.read_fwf(
-            io.StringIO(decoded.decode("utf-8")),
-            widths=[13, 8, 8, 2, 10, 3, 7, 4, 2, 2, 2, 8, 2, 2],
-            header=None
-        )
-        df.columns = [
-            "Frequency",
-            "Uncertainty",
-            "Intensity",
-            "DoF",
-            "Lower state energy",
-            "Degeneracy",
-            "ID",
-            "Coding",
-            "N'",
-            "F'",
-            "J'",
-            "N''",
-            "F''",
-            "J''"
+        # Only the frequency, intensity, and lower state energy columns
+        # of the SPCAT format are needed, which are the first, third and
+        # fifth fixed-width fields, so they are sliced straight out of
+        # each line; float() reads the bytes without decoding them first
+        lines = [
+            line for line in _decode_upload(contents).getvalue().splitlines()
+            if line.strip()
+        ]
+        frequency, intensity, lower_energy = [
+            np.fromiter(
+                (float(line[start:end]) for line in lines),
+                dtype=np.float64,
+                count=len(lines)
+            )
+            for start, end in [(0, 13), (21, 29), (31, 41)]
         ]
-        df["Upper state"] = utils.MHz2cm(df["Frequency"]) + df["Lower state energy"]
-        df["Upper state Kelvin"] = df["Upper state"] / utils.kbcm
+        upper_energy = utils.MHz2cm(frequency) + lower_energy
         pack = {
-            "frequency": df["Frequency"].astype(float),
-            "intensity": 10**df["Intensity"].astype(float),
+            "frequency": frequency,
+            "intensity": np.exp(intensity * _LN10),
             "molecule": os.path.basename(filename).split(".")[0],
-            "state_energies": df["Upper state Kelvin"].astype(float)
+            "state_energies": utils.wavenumber2T(upper_energy)
         }
         cat_obj = cls(**pack)
         return cat_obj
 
+    @classmethod
+    def from_store(cls, data):
+        """
+        Method for recreating a Catalog object from the output of `to_store`.
+        :param data: dict of stored catalog data
+        :return: Catalog object
+        """
+        data = dict(data)
+        for key in ["frequency", "intensity", "state_energies"]:
+            data[key] = _decode_array(data[key])
+        return cls(**data)
+
+    def to_store(self):
+        """
+        Packs the catalog into a dict for storage, with the catalog lines
+        encoded as base64 strings of float64 bytes.
+        :return: dict of stored catalog data
+        """
+        data = dict(self.__dict__)
+        for key in ["frequency", "intensity", "state_energies"]:
+            data[key] = _encode_array(data[key])
+        return data
+
     def generate_spectrum(self, spec_x):
         """
         Generate a synthetic spectrum using the catalog data. Each frequency is represented
@@ -113,33 +235,116 @@ class Catalog:
         :param spec_x: np.array corresponding to the frequencies to be evaluated
         :return: np.array containing y values
         """
-        spec_y = np.zeros(len(spec_x))
-        spec_x = np.array(spec_x)
-        self.Q = utils.partition_function(self.state_energies, self.temperature)
-        I = utils.I2S(self.intensity, self.Q, self.frequency, self.state_energies, self.temperature)
-        flux = utils.N2flux(
+        spec_x = np.asarray(spec_x, dtype=float)
+        # Large spectra are kept in single precision, which is plenty for
+        # plotting and halves their memory and payload size
+        if SPECTRON_FP32 and spec_x.size * len(self.frequency) > _FP32_THRESHOLD:
+            dtype = np.float32
+        else:
+            dtype = np.float64
+        digest = hashlib.sha1(spec_x.tobytes())
+        for array in [self.frequency, self.intensity, self.state_energies]:
+            digest.update(np.ascontiguousarray(array).tobytes())
+        key = (
+            digest.hexdigest(),
+            np.dtype(dtype).str,
+            self.temperature,
             self.column_density,
-            I,
-            self.frequency,
-            self.Q,
-            self.state_energies,
-            self.temperature
+            self.doppler
         )
-        dopp_freq = utils.dop2freq(self.doppler, self.frequency)
-        amplitudes = flux / np.sqrt(2. * np.pi**2. * dopp_freq)
-        # Frequency, doppler shift in frequency, amplitude
-        for c, w, a in zip(self.frequency, dopp_freq, amplitudes):
-            spec_y+=utils.gaussian(spec_x, a, c, w)
+        with _SPEC_CACHE_LOCK:
+            cached = _SPEC_CACHE.get(key)
+            if cached is not None:
+                _SPEC_CACHE.move_to_end(key)
+        if cached is not None:
+            self.Q, spec_y = cached
+            return spec_y
+        spec_y = self.generate_into(spec_x, np.zeros(len(spec_x), dtype=dtype))
+        # The same array is handed to every caller, so it can't be modified
+        spec_y.flags.writeable = False
+        with _SPEC_CACHE_LOCK:
+            _SPEC_CACHE[key] = (self.Q, spec_y)
+            if len(_SPEC_CACHE) > _SPEC_CACHE_SIZE:
+                _SPEC_CACHE.popitem(last=False)
         return spec_y
 
+    def generate_into(self, spec_x, out):
+        """
+        Add the synthetic spectrum of the catalog into an existing array, rather
+        than allocating a new one. Unlike `generate_spectrum`, the result is not
+        memoized.
+
+        :param spec_x: np.array corresponding to the frequencies to be evaluated
+        :param out: np.array the same length as spec_x to accumulate into
+        :return: np.array out
+        """
+        spec_x = np.asarray(spec_x, dtype=float)
+        # A catalog without lines contributes nothing
+        if self.frequency.size == 0:
+            self.Q = 0.
+            return out
+        # The upper state Boltzmann factors give both the partition function,
+        # summed over every line, and the line strengths and fluxes. The
+        # energies are already in K, so they are used without conversion,
+        # and are promoted to double precision within the same pass
+        boltzmann = np.exp(
+            np.multiply(self.state_energies, -1. / self.temperature, dtype=float)
+        )
+        self.Q = np.sum(boltzmann)
+        # Only the lines close enough to contribute to the spectrum window
+        # are evaluated; the widest line is the one at the highest frequency
+        window = _LINE_WINDOW * utils.dop2freq(self.doppler, self.frequency[-1])
+        lower = np.searchsorted(self.frequency, spec_x.min() - window)
+        upper = np.searchsorted(self.frequency, spec_x.max() + window, side="right")
+        frequency = np.asarray(self.frequency[lower:upper], dtype=float)
+        amplitudes, dopp_freq = utils.line_amplitudes(
+            np.asarray(self.intensity[lower:upper], dtype=float),
+            frequency,
+            boltzmann[lower:upper],
+            self.Q,
+            self.column_density,
+            self.temperature,
+            self.doppler
+        )
+        # The line profiles are evaluated in double precision, whatever the
+        # precision of the output, as rounding the frequencies would shift
+        # the line centres by a sizeable fraction of a narrow line width
+        return utils.accumulate_gaussians(
+            spec_x,
+            amplitudes,
+            frequency,
+            dopp_freq,
+            out,
+            _LINE_WINDOW
+        )
+
+    @staticmethod
+    def table_format(data):
+        """
+        Puts a dict of catalog data, such as the output of `to_store`, into
+        DataTable format without creating a Catalog object.
+        :param data: dict of catalog data
+        :return: dict corresponding to everything in the data except the catalog lines
+        """
+        ignore = ["frequency", "intensity", "state_energies"]
+        return {key: value for key, value in data.items() if key not in ignore}
+
     def to_table_format(self):
         """
         Puts the catalog data into DataTable format.
         :return: dict corresponding to everything in the class except the catalog lines
         """
-        ignore = ["frequency", "intensity", "state_energies"]
-        data = {key: value for key, value in self.__dict__.items() if key not in ignore}
-        return data
+        return self.table_format(self.__dict__)
+
+
+# Parsers for each of the recognized file extensions
+_PARSERS = {
+    ".txt": Spectrum.from_upload,
+    ".spec": Spectrum.from_upload,
+    ".csv": Spectrum.from_upload,
+    ".lin": Catalog.from_upload,
+    ".cat": Catalog.from_upload
+}
 
 
 def process_upload(filestream, filename):
@@ -151,10 +356,7 @@ def process_upload(filestream, filename):
     :param filename: str filename
     :return: object instance corresponding to the filetype
     """
-    spec_ext = [".txt", ".spec", ".csv"]
-    cat_ext = [".lin", ".cat"]
-    if any(ext in filename for ext in spec_ext) is True:
-        parser = Spectrum.from_upload
-    elif any(ext in filename for ext in cat_ext) is True:
-        parser = Catalog.from_upload
+    parser = _PARSERS.get(os.path.splitext(filename)[1].lower())
+    if parser is None:
+        raise ValueError("Unsupported file extension: {}".format(filename))
     return parser(filestream, filename)
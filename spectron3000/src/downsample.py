@@ -0,0 +1,53 @@
+""" downsample.py
+
+    Routines for reducing the number of points in a trace before it
+    is sent to the browser, while keeping its visual features.
+"""
+
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True)
+def lttb(x, y, n_out):
+    """
+    Downsample a trace with the Largest-Triangle-Three-Buckets algorithm.
+    The points between the first and last are split into buckets, and from
+    each bucket the point forming the largest triangle with the previously
+    selected point and the average of the next bucket is kept; this keeps
+    peaks that plain striding would skip over. x should be monotonic, and
+    non-finite points should be removed beforehand; they are never chosen
+    over finite ones, but spoil the averages of their neighbouring bucket.
+    :param x: np.array x values
+    :param y: np.array y values
+    :param n_out: int number of points to keep
+    :return: np.array of indices of the points to keep
+    """
+    n = x.size
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0] = 0
+    indices[n_out - 1] = n - 1
+    bucket = (n - 2) / (n_out - 2)
+    selected = 0
+    for i in range(n_out - 2):
+        # Average of the next bucket is the third point of the triangle
+        start = int((i + 1) * bucket) + 1
+        end = min(int((i + 2) * bucket) + 1, n)
+        avg_x = x[start:end].mean()
+        avg_y = y[start:end].mean()
+        # Seed with the first point of the bucket, so a point is always
+        # selected even if every area is NaN
+        indices[i + 1] = int(i * bucket) + 1
+        largest = -1.
+        for j in range(int(i * bucket) + 1, start):
+            area = abs(
+                (x[selected] - avg_x) * (y[j] - y[selected])
+                - (x[selected] - x[j]) * (avg_y - y[selected])
+            )
+            if area > largest:
+                largest = area
+                indices[i + 1] = j
+        selected = indices[i + 1]
+    return indices
@@ -1,5 +1,27 @@
 
+import numpy as np
+import orjson
 from plotly import graph_objs as go
+from plotly.utils import PlotlyJSONEncoder
+
+from src import downsample
+
+
+class OrjsonEncoder(PlotlyJSONEncoder):
+    """
+    JSON encoder for Plotly figures that serializes with orjson, which
+    writes NumPy arrays natively rather than element by element. Anything
+    orjson can't serialize falls back to the regular Plotly encoder.
+    """
+    def encode(self, o):
+        try:
+            return orjson.dumps(
+                o,
+                default=self.default,
+                option=orjson.OPT_SERIALIZE_NUMPY
+            ).decode("utf-8")
+        except TypeError:
+            return super().encode(o)
 
 
 def init_layout():
@@ -25,17 +47,33 @@ def init_layout():
     return layout
 
 
-def plot_spectrum(x, y, name, **kwargs):
+def plot_spectrum(x, y, name, threshold=8192, n_out=4096, **kwargs):
     """
     Generates a Plotly scatter plot with the Scattergl function.
     This function specifically optimizes for performance, given that the
-    datasets we're dealing with generally have many thousands of points.
+    datasets we're dealing with generally have many thousands of points;
+    traces longer than `threshold` are downsampled with LTTB to `n_out`
+    points before they are sent to the browser.
     :param x: np.array of x values
     :param y: np.array of y values
     :param name: str denoting the legend value
+    :param threshold: int number of points above which the trace is downsampled
+    :param n_out: int number of points to downsample to
     :param kwargs: additional kwargs for specifying the plot
     :return: Scattergl object
     """
+    if len(x) > threshold:
+        x = np.asarray(x)
+        y = np.asarray(y)
+        # Missing values, e.g. from blank cells in an upload, are dropped
+        # as they can't be compared when picking points
+        finite = np.isfinite(x) & np.isfinite(y)
+        if not finite.all():
+            x = x[finite]
+            y = y[finite]
+        indices = downsample.lttb(x, y, n_out)
+        x = x[indices]
+        y = y[indices]
     trace = go.Scattergl(
         x=x,
         y=y,
@@ -6,6 +6,7 @@
 """
 
 import numpy as np
+from numba import njit, prange
 from scipy import constants
 
 
@@ -15,6 +16,15 @@ eha = constants.value("Hartree energy")
 harm = constants.value("hartree-inverse meter relationship")
 jm = constants.value("joule-inverse meter relationship")
 
+# Derived conversion factors, so each conversion is a single multiplication
+_MHZ2CM = 1e4 / constants.c
+_CM2MHZ = constants.c / 1e4
+_DOP2FREQ = 1000. / constants.c
+_INV_KBCM = 1. / kbcm
+_SQRT_2PI2 = np.sqrt(2. * np.pi**2.)
+# Flux scaling of N2flux: MHz to GHz cubed, the 1e20 and the 2.04 in one
+_N2FLUX = 1. / (1e9 * 1e20 * 2.04)
+
 
 def kappa(A, B, C):
     # Ray's asymmetry parameter
@@ -85,7 +95,7 @@ def MHz2cm(frequency):
     :param frequency: float
     :return: corresponding value in 1/cm
     """
-    return (frequency / 1000.) / (constants.c / 1e7)
+    return frequency * _MHZ2CM
 
 
 def cm2MHz(wavenumber):
@@ -94,7 +104,7 @@ def cm2MHz(wavenumber):
     :param wavenumber: float
     :return: corresponding value in MHz
     """
-    return (wavenumber * (constants.c / 1e7)) * 1000.
+    return wavenumber * _CM2MHZ
 
 
 def hartree2kjmol(hartree):
@@ -130,7 +140,7 @@ def wavenumber2T(wavenumber):
     :param wavenumber: float
     :return: corresponding value in K
     """
-    return wavenumber / kbcm
+    return wavenumber * _INV_KBCM
 
 
 """ 
@@ -150,7 +160,7 @@ def dop2freq(velocity, frequency):
     """
     # Frequency given in MHz, Doppler_shift given in km/s
     # Returns the expected Doppler shift in frequency (MHz)
-    return ((velocity * 1000. * frequency) / constants.c)
+    return velocity * _DOP2FREQ * frequency
 
 
 def freq2vel(frequency, offset):
@@ -207,10 +217,22 @@ def gaussian_integral(amplitude, sigma):
     :param sigma: width of the Gaussian
     :return: integrated area of the Gaussian
     """
-    integral = amplitude * np.sqrt(2. * np.pi**2. * sigma)
+    integral = amplitude * _SQRT_2PI2 * np.sqrt(sigma)
     return integral
 
 
+def gaussian_amplitude(integral, sigma):
+    """
+    Calculate the amplitude of a Gaussian analytically using the integrated
+    area and sigma; the inverse of `gaussian_integral`.
+    :param integral: integrated area of the Gaussian
+    :param sigma: width of the Gaussian
+    :return: amplitude of the Gaussian
+    """
+    amplitude = integral / (_SQRT_2PI2 * np.sqrt(sigma))
+    return amplitude
+
+
 def N2flux(N, S, v, Q, E, T):
     """
     Calculate the expected flux in Jy for a given set of parameters.
@@ -222,9 +244,7 @@ def N2flux(N, S, v, Q, E, T):
     :param T: temperature
     :return: integrated flux in Jy
     """
-    numerator = (N * S * (v / 1e3)**3.) / 1e20
-    denominator = 2.04 * Q * np.exp(E / T)
-    flux = numerator / denominator
+    flux = (N * _N2FLUX / Q) * S * (v * v * v) * np.exp(E * (-1. / T))
     return flux
 
 
@@ -236,7 +256,7 @@ def boltzmann_factor(E, T):
     :param T: temperature in K
     :return: float Boltzmann factor
     """
-    return np.exp(-E / (kbcm * T))
+    return np.exp(E * (-_INV_KBCM / T))
 
 
 def I2S(I, Q, frequency, E_upper, T):
@@ -251,13 +271,39 @@ def I2S(I, Q, frequency, E_upper, T):
     :param T: temperature in K
     :return: intrinsic line strength; Su^2
     """
-    E_upper = E_upper * kbcm
-    E_lower = MHz2cm(cm2MHz(E_upper) - frequency)
+    boltzmann_upper = boltzmann_factor(E_upper * kbcm, T)
+    # The lower state sits one transition energy below the upper state
+    boltzmann_lower = boltzmann_upper * np.exp(frequency * (_MHZ2CM * _INV_KBCM / T))
     A = I * Q
-    B = (4.16231e-5 * frequency * (boltzmann_factor(E_lower, T) - boltzmann_factor(E_upper, T)))
+    B = (4.16231e-5 * frequency * (boltzmann_lower - boltzmann_upper))
     return A / B
 
 
+def line_amplitudes(I, frequency, boltzmann, Q, N, T, doppler):
+    """
+    Calculate the Gaussian amplitudes and widths of a set of catalog lines
+    for a given column density, temperature and Doppler width. This is
+    equivalent to chaining `I2S`, `N2flux` and `dop2freq`, but takes the
+    upper state Boltzmann factors exp(-E_upper / T) so that they can be
+    shared with the partition function instead of being recomputed.
+    :param I: transition intensity in nm^2 MHz
+    :param frequency: transition frequency in MHz
+    :param boltzmann: upper state Boltzmann factors
+    :param Q: partition function
+    :param N: column density in cm^-2
+    :param T: temperature in K
+    :param doppler: Doppler width in km/s
+    :return: amplitudes and widths of the Gaussians
+    """
+    # The lower state sits one transition energy below the upper state
+    boltzmann_lower = boltzmann * np.exp(frequency * (_MHZ2CM * _INV_KBCM / T))
+    S = (I * Q) / (4.16231e-5 * frequency * (boltzmann_lower - boltzmann))
+    flux = (N * _N2FLUX / Q) * S * (frequency * frequency * frequency) * boltzmann
+    sigma = dop2freq(doppler, frequency)
+    amplitudes = gaussian_amplitude(flux, sigma)
+    return amplitudes, sigma
+
+
 def gaussian(x, amplitude, center, sigma):
     """
     Calculate the value of a normalized Gaussian distribution for a given
@@ -269,3 +315,41 @@ def gaussian(x, amplitude, center, sigma):
     :return: np.array
     """
     return (amplitude / (np.pi * sigma)) * np.exp(-(1.0 * x - center) ** 2 / (2 * sigma ** 2))
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def accumulate_gaussians(x, amplitudes, centers, sigmas, out, nsigma=8.):
+    """
+    Add the sum of many Gaussians, with the same normalization as `gaussian`,
+    over a grid of x values into an existing array. Each grid point is
+    evaluated in parallel, and only the Gaussians centered within `nsigma`
+    widths of the point are summed; the centers are binary searched, and so
+    must be sorted in ascending order.
+    :param x: np.array x values
+    :param amplitudes: np.array of amplitudes
+    :param centers: np.array of sorted centers
+    :param sigmas: np.array of widths
+    :param out: np.array the same length as x to accumulate into
+    :param nsigma: float number of widths to include either side of a center
+    :return: np.array out
+    """
+    if centers.size == 0:
+        return out
+    window = nsigma * sigmas.max()
+    # Per-line constants, so the inner loop is only a multiply and exp
+    heights = amplitudes / (np.pi * sigmas)
+    inv_two_var = 1. / (2. * sigmas**2)
+    # The search window is sized for the widest line; narrower lines are
+    # skipped once the point is beyond nsigma of their own width
+    limit = 0.5 * nsigma**2
+    for i in prange(x.size):
+        lower = np.searchsorted(centers, x[i] - window)
+        upper = np.searchsorted(centers, x[i] + window)
+        total = 0.
+        for j in range(lower, upper):
+            delta = x[i] - centers[j]
+            exponent = delta * delta * inv_two_var[j]
+            if exponent < limit:
+                total += heights[j] * np.exp(-exponent)
+        out[i] += total
+    return out
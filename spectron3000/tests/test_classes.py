@@ -0,0 +1,84 @@
+import base64
+
+import numpy as np
+
+from src import classes
+
+
+def test_spectrum_store_roundtrip():
+    """
+    Stored spectra must keep the full resolution of the frequency axis.
+    """
+    x = np.arange(280e3, 280e3 + 100., 0.005)
+    spec_obj = classes.Spectrum(x, np.ones_like(x))
+    restored = classes.Spectrum.from_store(spec_obj.to_store())
+    assert np.array_equal(restored.x, x)
+    assert np.array_equal(restored.y, spec_obj.y)
+
+
+def test_generate_spectrum_memo():
+    """
+    A corrected catalog with the same name and number of lines must not
+    reuse the spectrum memoized for the original.
+    """
+    spec_x = np.linspace(10000., 10100., 1001)
+    first = classes.Catalog([10020., 10050.], [1e-3, 1e-3], [10., 20.], "test")
+    second = classes.Catalog([10030., 10070.], [1e-3, 1e-3], [10., 20.], "test")
+    first_y = first.generate_spectrum(spec_x)
+    second_y = second.generate_spectrum(spec_x)
+    assert np.argmax(first_y) != np.argmax(second_y)
+    assert np.array_equal(first.generate_spectrum(spec_x), first_y)
+
+
+def test_generate_spectrum_fp32():
+    """
+    Single precision output must not shift the peaks of narrow lines.
+    """
+    spec_x = np.arange(280000., 280010., 0.005)
+    cat_obj = classes.Catalog([280004.0037], [1e-3], [10.], "test", doppler=0.1)
+    expected = cat_obj.generate_into(spec_x, np.zeros(spec_x.size))
+    result = cat_obj.generate_into(spec_x, np.zeros(spec_x.size, dtype=np.float32))
+    assert np.allclose(result, expected, rtol=1e-5, atol=1e-6 * expected.max())
+
+
+def test_generate_spectrum_memo_readonly():
+    """
+    Memoized spectra are shared between sessions, and so can't be modified
+    in place; changing the precision gives a separately memoized spectrum.
+    """
+    spec_x = np.linspace(10000., 10100., 1001)
+    cat_obj = classes.Catalog([10020., 10050.], [1e-3, 1e-3], [10., 20.], "test")
+    spec_y = cat_obj.generate_spectrum(spec_x)
+    assert not spec_y.flags.writeable
+    threshold = classes._FP32_THRESHOLD
+    try:
+        classes._FP32_THRESHOLD = 0
+        assert cat_obj.generate_spectrum(spec_x).dtype == np.float32
+        classes.SPECTRON_FP32 = False
+        assert cat_obj.generate_spectrum(spec_x).dtype == np.float64
+    finally:
+        classes._FP32_THRESHOLD = threshold
+        classes.SPECTRON_FP32 = True
+
+
+def test_spectrum_from_upload_single_row():
+    """
+    A spectrum with a single row must still be read into arrays.
+    """
+    contents = "data:text/plain;base64," + base64.b64encode(b"x\ty\n1.0\t2.0\n").decode()
+    spec_obj = classes.Spectrum.from_upload(contents, "single.txt")
+    assert spec_obj.x.shape == (1,)
+    assert spec_obj.y.shape == (1,)
+
+
+def test_generate_spectrum_no_lines():
+    """
+    A catalog without any lines, e.g. from an upload of blank lines, gives
+    an empty spectrum rather than failing.
+    """
+    contents = "data:text/plain;base64," + base64.b64encode(b"\n\n").decode()
+    cat_obj = classes.Catalog.from_upload(contents, "empty.cat")
+    spec_x = np.linspace(10000., 10100., 1001)
+    spec_y = cat_obj.generate_spectrum(spec_x)
+    assert np.array_equal(spec_y, np.zeros_like(spec_x))
+    assert cat_obj.Q == 0.
@@ -0,0 +1,27 @@
+import numpy as np
+
+from src import downsample, plotting
+
+
+def test_lttb_nan():
+    """
+    NaN values must not leave indices unset, which would index out of
+    bounds inside the compiled kernel.
+    """
+    x = np.linspace(0., 1., 10000)
+    y = np.sin(x * 50.)
+    y[::7] = np.nan
+    y[:2000] = np.nan
+    indices = downsample.lttb(x, y, 4096)
+    assert len(indices) == 4096
+    assert indices.min() >= 0 and indices.max() < x.size
+    assert np.all(np.diff(indices) > 0)
+
+
+def test_plot_spectrum_nan():
+    x = np.linspace(0., 1., 10000)
+    y = np.sin(x * 50.)
+    y[::3] = np.nan
+    trace = plotting.plot_spectrum(x, y, "test")
+    assert len(trace.x) == 4096
+    assert np.isfinite(trace.y).all()